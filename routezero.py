@@ -1,21 +1,25 @@
-import boto3
-import collections
+import concurrent.futures
+import functools
+import hashlib
 import itertools
+import json
 import os
-import re
-import runpy
-import sys
-import tempfile
+import string
+import time
 import urllib.parse
-import uuid
 
 import requests
-from troposphere import Template
-from troposphere.cloudformation import WaitConditionHandle
-from troposphere.route53 import RecordSet, RecordSetGroup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 NAME_NAMESPACE = "zerotier"
 NODE_NAMESPACE = "zerotier-node"
+TEMPLATE_BODY_LIMIT = 51200
+
+_HOSTNAME_LABEL_CHARS = (string.ascii_letters + string.digits + "-").encode("ascii")
+
+# reused across invocations on warm lambda containers
+_ZEROTIER = None
 
 
 class Zerotier:
@@ -23,6 +27,16 @@ class Zerotier:
         self._api_url = api_url
         self._session = requests.Session()
         self._session.headers["Authorization"] = f"bearer {api_key}"
+        retry = Retry(
+            total=3,
+            backoff_factor=0.2,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False,
+        )
+        self._session.mount(
+            "https://",
+            HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retry),
+        )
 
     def get(self, url, *args, **kwargs):
         response = self._session.get(
@@ -32,42 +46,45 @@ class Zerotier:
         return response.json()
 
     def get_network(self, network_id):
-        network = self.get(f"/api/network/{network_id}")
-        network["members"] = self.get(f"/api/network/{network_id}/member")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            network = executor.submit(self.get, f"/api/network/{network_id}")
+            members = executor.submit(self.get, f"/api/network/{network_id}/member")
+            network = network.result()
+            network["members"] = members.result()
         return network
 
 
-def run_as_module(*args):
-    original_argv = sys.argv[:]
-    sys.argv = list(args)
-    try:
-        runpy.run_module(args[0], run_name="__main__")
-    except SystemExit as ex:
-        if ex.code:
-            raise
-    finally:
-        sys.argv = original_argv
-
-
+@functools.lru_cache(maxsize=4096)
 def punify_label(label):
-    try:
-        return label.encode("ascii").decode("ascii")
-    except Exception:
-        return "xn--" + label.encode("punycode").decode("ascii")
+    if label.isascii():
+        return label
+    return "xn--" + label.encode("punycode").decode("ascii")
+
+
+def is_valid_hostname_label(label):
+    label = label.encode("ascii", "replace")
+    return (
+        0 < len(label) <= 63
+        and label[0] != ord("-")
+        and label[-1] != ord("-")
+        and not label.translate(None, _HOSTNAME_LABEL_CHARS)
+    )
 
 
 def is_valid_hostname(hostname):
     if len(hostname) > 255:
         return False
-    if hostname[-1] == ".":
+    if hostname.endswith("."):
         hostname = hostname[:-1]
-    allowed = re.compile("(?!-)[A-Z\d-]{1,63}(?<!-)$", re.IGNORECASE)
-    return all(allowed.match(x) for x in hostname.split("."))
+    return all(map(is_valid_hostname_label, hostname.split(".")))
 
 
 def get_rfc4193_address(network_id, node_id):
-    address = "fd" + network_id + "9993" + node_id
-    return ":".join(address[i : i + 4] for i in range(0, len(address), 4))
+    a = "fd" + network_id + "9993" + node_id
+    return (
+        f"{a[0:4]}:{a[4:8]}:{a[8:12]}:{a[12:16]}:"
+        f"{a[16:20]}:{a[20:24]}:{a[24:28]}:{a[28:32]}"
+    )
 
 
 def dnsjoin(*args):
@@ -76,66 +93,126 @@ def dnsjoin(*args):
 
 
 def create_records(zone_name, network):
-    records = collections.defaultdict(dict)
-    for namespace in (NAME_NAMESPACE, NODE_NAMESPACE):
-        records[dnsjoin(namespace, zone_name)]["TXT"] = ['"' + network["id"] + '"']
+    records = {}
+    network_id = network["id"]
+    rfc4193 = network["config"]["v6AssignMode"]["rfc4193"]
+    name_suffix = dnsjoin(NAME_NAMESPACE, zone_name)
+    node_suffix = dnsjoin(NODE_NAMESPACE, zone_name)
+    for suffix in (name_suffix, node_suffix):
+        records[suffix, "TXT"] = ['"' + network_id + '"']
     for member in network["members"]:
-        if not member["config"]["authorized"] or not member["config"]["ipAssignments"]:
+        config = member["config"]
+        if not config["authorized"] or not config["ipAssignments"]:
             continue
-        node = dnsjoin(member["nodeId"], NODE_NAMESPACE, zone_name)
-        name = dnsjoin(member["name"], NAME_NAMESPACE, zone_name)
-        ipv4 = [ip for ip in member["config"]["ipAssignments"] if ":" not in ip]
-        ipv6 = [ip for ip in member["config"]["ipAssignments"] if ":" in ip]
-        if network["config"]["v6AssignMode"]["rfc4193"]:
-            ipv6.append(get_rfc4193_address(network["id"], member["nodeId"]))
-        records[node]["A"] = ipv4
-        records[node]["AAAA"] = ipv6
+        node = f"{punify_label(member['nodeId'])}.{node_suffix}"
+        name = f"{dnsjoin(member['name'])}.{name_suffix}"
+        ipv4, ipv6 = [], []
+        for ip in config["ipAssignments"]:
+            (ipv6 if ":" in ip else ipv4).append(ip)
+        if rfc4193:
+            ipv6.append(get_rfc4193_address(network_id, member["nodeId"]))
+        records[node, "A"] = ipv4
+        records[node, "AAAA"] = ipv6
         if is_valid_hostname(name):
-            records[name]["CNAME"] = [node]
-    return dict(records)
+            records[name, "CNAME"] = [node]
+    return records
 
 
 def create_template(zone_name, records):
+    from troposphere import Template
+    from troposphere.cloudformation import WaitConditionHandle
+    from troposphere.route53 import RecordSet, RecordSetGroup
+
     template = Template(Description="Dynamic DNS entries for ZeroTier")
-    record_sets = []
     zone_name = zone_name.rstrip(".") + "."
-    for name in records:
-        for type, values in records[name].items():
-            record_sets.append(
-                RecordSet(Name=name, Type=type, ResourceRecords=values, TTL=300)
-            )
+    record_sets = [
+        RecordSet(Name=name, Type=type, ResourceRecords=values, TTL=300)
+        for (name, type), values in records.items()
+    ]
     template.add_resource(
         RecordSetGroup("Records", HostedZoneName=zone_name, RecordSets=record_sets)
     )
-    # ensure there is always some "change" to deploy to cloudformation
+    # tie the dummy resource to the records so unchanged networks are a no-op
+    digest = hashlib.blake2b(
+        json.dumps(sorted(records.items())).encode("utf-8"), digest_size=16
+    )
     template.add_resource(
-        WaitConditionHandle("DummyChange" + str(uuid.uuid4()).replace("-", "").upper())
+        WaitConditionHandle("DummyChange" + digest.hexdigest().upper())
     )
     return template
 
 
-def deploy_stack(stack_name, template, client=None):
-    client = client or boto3.client("cloudformation")
-    methods = [
-        (client.create_stack, client.get_waiter("stack_create_complete")),
-        (client.update_stack, client.get_waiter("stack_update_complete")),
-    ]
-    for method, waiter in methods:
+def wait_for_stack(stack_name, client, *, max_delay=30, timeout=60 * 14):
+    deadline = time.monotonic() + timeout
+    delay = 1
+    while True:
+        try:
+            stack = client.describe_stacks(StackName=stack_name)["Stacks"][0]
+        except client.exceptions.ClientError as ex:
+            if ex.response["Error"]["Code"] != "Throttling":
+                raise
+        else:
+            status = stack["StackStatus"]
+            if status in ("CREATE_COMPLETE", "UPDATE_COMPLETE"):
+                return
+            if not status.endswith("_IN_PROGRESS"):
+                raise RuntimeError(f"Stack {stack_name} finished as {status}")
+        if time.monotonic() + delay > deadline:
+            raise TimeoutError(f"Stack {stack_name} did not finish in {timeout}s")
+        time.sleep(delay)
+        delay = min(max_delay, delay * 2)
+
+
+@functools.lru_cache(maxsize=None)
+def get_client(service_name):
+    import boto3
+
+    return boto3.client(service_name)
+
+
+def upload_template(bucket, template, client=None):
+    client = client or get_client("s3")
+    body = template.encode("utf-8")
+    key = f"templates/{hashlib.blake2b(body, digest_size=16).hexdigest()}.json"
+    client.put_object(Bucket=bucket, Key=key, Body=body)
+    return f"https://{bucket}.s3.{client.meta.region_name}.amazonaws.com/{key}"
+
+
+def deploy_stack(stack_name, template=None, client=None, *, template_url=None):
+    client = client or get_client("cloudformation")
+    if template_url is not None:
+        source = {"TemplateURL": template_url}
+    else:
+        source = {"TemplateBody": template}
+    for method in (client.create_stack, client.update_stack):
         try:
-            method(StackName=stack_name, TemplateBody=template)
+            method(StackName=stack_name, **source)
         except client.exceptions.AlreadyExistsException:
             continue
-        waiter.wait(StackName=stack_name, WaiterConfig={"Delay": 10, "MaxAttempts": 60})
+        except client.exceptions.ClientError as ex:
+            if "No updates are to be performed" in ex.response["Error"]["Message"]:
+                return
+            raise
+        return wait_for_stack(stack_name, client)
 
 
 def handler(event, context):
-    api_key = os.environ["ZEROTIER_API_KEY"]
+    global _ZEROTIER
+    if _ZEROTIER is None:
+        _ZEROTIER = Zerotier(os.environ["ZEROTIER_API_KEY"])
     network_id = os.environ["ZEROTIER_NETWORK_ID"]
-    network = Zerotier(api_key).get_network(network_id)
+    stack_name = os.environ["ROUTE53_RECORD_STACK_NAME"]
+    network = _ZEROTIER.get_network(network_id)
     records = create_records(network["config"]["name"], network)
     template = create_template(network["config"]["name"], records)
-    print(template.to_json(indent=None))
-    deploy_stack(os.environ["ROUTE53_RECORD_STACK_NAME"], template.to_json())
+    body = template.to_json(indent=None)
+    print(body)
+    if len(body.encode("utf-8")) > TEMPLATE_BODY_LIMIT:
+        # cloudformation only accepts larger templates by s3 url
+        bucket = os.environ["ROUTE53_RECORD_TEMPLATE_BUCKET"]
+        deploy_stack(stack_name, template_url=upload_template(bucket, body))
+    else:
+        deploy_stack(stack_name, body)
 
 
 if __name__ == "__main__":
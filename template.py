@@ -1,13 +1,13 @@
 #!/usr/bin/env python3
 
-import contextlib
+import hashlib
 import os
-import runpy
 import shutil
+import subprocess
 import sys
-import tempfile
+import zipfile
 
-from awacs import cloudformation, route53
+from awacs import cloudformation, route53, s3
 from awacs.aws import Allow, PolicyDocument, Statement
 from awacs.helpers.trust import get_lambda_assumerole_policy
 from troposphere import GetAtt, Parameter, Ref, Sub, Template
@@ -15,34 +15,73 @@ from troposphere.events import Rule, Target
 from troposphere.awslambda import Environment, Function, Permission
 from troposphere.iam import Policy, Role
 from troposphere.logs import LogGroup
+from troposphere.s3 import Bucket, LifecycleConfiguration, LifecycleRule
 
 import routezero
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 BUNDLE = os.path.join(SCRIPT_DIR, "bundle.zip")
+BUNDLE_DIGEST = BUNDLE + ".sha"
 REQUIREMENTS = os.path.join(SCRIPT_DIR, "requirements.txt")
+PACKAGES = os.path.join(os.path.expanduser("~"), ".cache", "routezero-bundle")
+PACKAGES_DIGEST = PACKAGES + ".sha"
 
 
 class CLIFunction(Function):
     props = {**Function.props, "Code": (str, True)}
 
 
+def get_bundle_digest():
+    digest = hashlib.blake2b()
+    for path in (routezero.__file__, REQUIREMENTS):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def install_requirements():
+    with open(REQUIREMENTS, "rb") as f:
+        digest = hashlib.blake2b(f.read()).hexdigest()
+    try:
+        with open(PACKAGES_DIGEST) as f:
+            if f.read() == digest and os.path.isdir(PACKAGES):
+                return PACKAGES
+    except OSError:
+        pass
+    shutil.rmtree(PACKAGES, ignore_errors=True)
+    subprocess.run(
+        [sys.executable, "-m", "pip", "install", "-t", PACKAGES, "-r", REQUIREMENTS],
+        check=True,
+        stdout=sys.stderr,
+    )
+    with open(PACKAGES_DIGEST, "w") as f:
+        f.write(digest)
+    return PACKAGES
+
+
+def create_archive(path, root_dir, *extra_files):
+    with zipfile.ZipFile(
+        path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1
+    ) as archive:
+        for dirpath, _, filenames in os.walk(root_dir):
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                archive.write(filepath, os.path.relpath(filepath, root_dir))
+        for filepath in extra_files:
+            archive.write(filepath, os.path.basename(filepath))
+
+
 def create_bundle():
+    digest = get_bundle_digest()
     try:
-        if os.path.getmtime(BUNDLE) > os.path.getmtime(routezero.__file__):
-            return BUNDLE
+        with open(BUNDLE_DIGEST) as f:
+            if f.read() == digest and os.path.exists(BUNDLE):
+                return BUNDLE
     except OSError:
         pass
-    with tempfile.TemporaryDirectory(".routezero") as tempdir:
-        with contextlib.redirect_stdout(sys.stderr):
-            routezero.run_as_module("pip", "install", "-t", tempdir, "-r", REQUIREMENTS)
-        shutil.copy2(routezero.__file__, tempdir)
-        shutil.make_archive(
-            base_name=os.path.splitext(BUNDLE)[0],
-            format=os.path.splitext(BUNDLE)[1].lstrip("."),
-            root_dir=tempdir,
-            base_dir=".",
-        )
+    create_archive(BUNDLE, install_requirements(), routezero.__file__)
+    with open(BUNDLE_DIGEST, "w") as f:
+        f.write(digest)
     return BUNDLE
 
 
@@ -50,6 +89,14 @@ def create_template():
     t = Template(Description="Infrastructure for routezero")
     api_key = t.add_parameter(Parameter("ZerotierApiKey", Type="String", NoEcho=True))
     network_id = t.add_parameter(Parameter("ZerotierNetworkId", Type="String"))
+    bucket = t.add_resource(
+        Bucket(
+            "TemplateBucket",
+            LifecycleConfiguration=LifecycleConfiguration(
+                Rules=[LifecycleRule(Status="Enabled", ExpirationInDays=1)]
+            ),
+        )
+    )
     role = t.add_resource(
         Role(
             "Role",
@@ -66,7 +113,15 @@ def create_template():
                                     route53.Action("*"),
                                 ],
                                 Resource=["*"],
-                            )
+                            ),
+                            Statement(
+                                Effect=Allow,
+                                Action=[
+                                    s3.Action("GetObject"),
+                                    s3.Action("PutObject"),
+                                ],
+                                Resource=[Sub("${TemplateBucket.Arn}/*")],
+                            ),
                         ]
                     ),
                 )
@@ -82,7 +137,7 @@ def create_template():
             MemorySize=256,
             Timeout=60 * 15,
             Handler=".".join([routezero.__name__, routezero.handler.__name__]),
-            Runtime="python3.6",
+            Runtime="python3.12",
             Code=create_bundle(),
             Role=GetAtt(role, "Arn"),
             Environment=Environment(
@@ -90,6 +145,7 @@ def create_template():
                     "ZEROTIER_API_KEY": Ref(api_key),
                     "ZEROTIER_NETWORK_ID": Ref(network_id),
                     "ROUTE53_RECORD_STACK_NAME": Sub("${AWS::StackName}Records"),
+                    "ROUTE53_RECORD_TEMPLATE_BUCKET": Ref(bucket),
                 }
             ),
         )